@@ -8,15 +8,27 @@ import multiprocessing as mp
 import sys
 import termios
 import os
+from queue import Empty
+import re
+import select
+import time
 
 import rich
 from rich.live import Live
 from watchgod import run_process, RegExpWatcher
 
 from nbtui import _METADATA
-from nbtui.display import display_notebook, Notebook
-from nbtui.parser import parse_nb, reparse_nb
-from nbtui.user_input import SetTermAttrs, get_char, handle_input
+from nbtui.display import (clear_images, display_notebook, image_query,
+                           redraw, Notebook, QUERY_ID, shared_memory)
+from nbtui.parser import parse_nb
+from nbtui.replay import TraceRecorder
+from nbtui.user_input import (SetTermAttrs, get_char, handle_file_change,
+                              handle_input)
+
+# how long the main loop waits for a keypress before checking for other work
+POLL_INTERVAL = 0.02
+# how often a followed notebook is checked for changes, in seconds
+FOLLOW_INTERVAL = 0.25
 
 def check_resized():
     term_width, term_height= os.get_terminal_size()
@@ -45,6 +57,70 @@ def parse_metadata():
     _METADATA["pix_per_row"] = pixels_per_row
     _METADATA["pix_per_col"] = pixels_per_col
 
+def query_terminal(query, timeout=1):
+    """
+    Sends {query} to the terminal, followed by a request for its primary
+    device attributes, which every terminal answers. Since replies arrive in
+    order, everything the terminal had to say about {query} has arrived once
+    that answer has, and we don't have to wait for the timeout on terminals
+    that ignore the query.
+    """
+    fd = sys.stdin.fileno()
+    reply = b""
+    with SetTermAttrs(fd):
+        sys.stdout.buffer.write(query + b"\033[c")
+        sys.stdout.flush()
+
+        deadline = time.monotonic() + timeout
+        while not re.search(rb"\033\[\?[0-9;]*c", reply):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                break
+            reply += os.read(fd, 1024)
+
+    return reply
+
+def probe_transmission(medium):
+    """
+    Ask the terminal whether it can read images through {medium}.
+    """
+    query, cleanup = image_query(medium)
+    try:
+        reply = query_terminal(query)
+    finally:
+        cleanup()
+    return b"i=%d;OK" % QUERY_ID in reply
+
+def parse_transmission(requested):
+    """
+    Pick how images are sent to the terminal. Passing pixels through shared
+    memory or a temporary file is much cheaper than base64 encoding them, but
+    only works when the terminal is running on this machine, so we ask the
+    terminal whether it can read them first, and otherwise fall back to
+    sending images inline.
+    """
+    _METADATA["transmission"] = "direct"
+    if not _METADATA["img_support"]:
+        return
+
+    if requested == "auto":
+        candidates = ["shm", "file"]
+    elif requested == "direct":
+        candidates = []
+    else:
+        candidates = [requested]
+
+    if shared_memory is None and "shm" in candidates:
+        candidates.remove("shm")
+
+    for medium in candidates:
+        if probe_transmission(medium):
+            _METADATA["transmission"] = medium
+            return
+
 def filewatch_worker(queue, filename):
 
     def on_changed(queue, filename):
@@ -61,23 +137,57 @@ def filewatch_worker(queue, filename):
             watcher_kwargs = {"re_files": filename},
             args=(queue, filename))
 
-def input_worker(in_queue, out_queue):
+def follow_worker(queue, filename):
+    """
+    Watches a notebook which is being executed. The executor rewrites
+    the file constantly, so instead of reacting to every write, we check the
+    file at most every FOLLOW_INTERVAL seconds, and skip any version of
+    it that was caught halfway through being written.
+    """
+    sys.stderr = open(os.devnull, "w")
+    sys.stdout = open(os.devnull, "w")
+
+    last_stat = None
+    while True:
+        time.sleep(FOLLOW_INTERVAL)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if stat == last_stat:
+            continue
+
+        try:
+            with open(filename, "r") as f:
+                new_nb = json.load(f)
+        except ValueError:
+            continue
+
+        last_stat = stat
+        queue.put(new_nb)
+
+def input_worker(in_queue):
     sys.stdin = open(0)
     fd = sys.stdin.fileno()
-    while True:
-        with SetTermAttrs(fd):
+    with SetTermAttrs(fd):
+        while True:
             c = get_char()
             in_queue.put(c)
 
-        # Block until main proc has processed the keypress
-        # this is so we don't clobber stdin for things like searching,
-        # where the user types additional characters after the inital
-        # press of /
-        _ = out_queue.get()
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("filename", type=str)
+    parser.add_argument("--transmission", default="auto",
+                        choices=["auto", "direct", "file", "shm"],
+                        help="how images are sent to the terminal")
+    parser.add_argument("--follow", action="store_true",
+                        help="keep the view pinned to the newest output of "
+                        "a notebook that is being executed")
+    parser.add_argument("--record", metavar="TRACE",
+                        help="record keypresses and file changes to TRACE, "
+                        "to be played back with python -m nbtui.replay")
     args = parser.parse_args()
 
     filename = args.filename
@@ -90,21 +200,26 @@ def main():
 
     _METADATA["language"] = nb["metadata"]["kernelspec"]["language"]
     parse_metadata()
+    parse_transmission(args.transmission)
     notebook = Notebook(parse_nb(nb))
 
     filewatch_queue = mp.Queue()
-    filewatch_p = mp.Process(target=filewatch_worker,
+    watcher = follow_worker if args.follow else filewatch_worker
+    filewatch_p = mp.Process(target=watcher,
                              args=(filewatch_queue, filename))
     filewatch_p.start()
 
     input_queue = mp.Queue()
-    out_queue = mp.Queue()
     input_p = mp.Process(target=input_worker, daemon=True,
-                         args=(input_queue, out_queue))
+                         args=(input_queue,))
     input_p.start()
 
     rendered_cells = display_notebook(notebook)
 
+    trace = None
+    if args.record is not None:
+        trace = TraceRecorder(args.record)
+
     with Live(transient=True,
               auto_refresh=False,
               vertical_overflow="crop",
@@ -116,26 +231,38 @@ def main():
         stop = False
         while not stop:
             if notebook.needs_redraw:
-                rendered_cells = display_notebook(notebook)
+                redraw(live, notebook)
 
-                sys.stdout.buffer.write(b"\x1b[2J\x1b[H")
-                live.update(rendered_cells, refresh=True)
-                notebook.draw_plots()
+            if notebook.search is not None:
+                notebook.search.poll(notebook)
 
             if not filewatch_queue.empty():
                 new_nb = filewatch_queue.get()
-                notebook = reparse_nb(new_nb, notebook)
+                # only the newest version of the file matters
+                while not filewatch_queue.empty():
+                    new_nb = filewatch_queue.get()
+
+                if trace is not None:
+                    trace.record(notebook=new_nb)
+                notebook = handle_file_change(new_nb, notebook, args.follow)
 
-            if not input_queue.empty():
-                char = input_queue.get()
+            try:
+                char = input_queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                pass
+            else:
+                if trace is not None:
+                    trace.record(key=char)
                 stop = handle_input(char, notebook)
-                # signal that the keypress was handled
-                out_queue.put(1)
 
             if check_resized():
                 parse_metadata()
-                notebook.needs_redraw = True
+                if trace is not None:
+                    trace.record_size()
+                notebook.relayout()
 
+    if trace is not None:
+        trace.close()
     filewatch_queue.close()
     input_queue.close()
 
@@ -143,6 +270,7 @@ def main():
     # as a daemon
     filewatch_p.terminate()
     filewatch_p.join()
+    clear_images()
     sys.stdout.buffer.write(b"\x1b[2J\x1b[H")
 
 if __name__ == "__main__":
@@ -1,14 +1,75 @@
-from base64 import decodebytes, b64encode
+from base64 import decodebytes
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 import io
 from math import ceil, floor
 import re
+from weakref import WeakValueDictionary
+from xml.etree import ElementTree
 
 from PIL import Image
 from rich.markdown import Markdown
 from rich.syntax import Syntax
 from rich.text import Text
 
-from nbtui import _METADATA
+try:
+    import cairosvg
+except (ImportError, OSError):
+    # cairosvg is optional, and also fails to import when the cairo
+    # library itself is missing
+    cairosvg = None
+
+from nbtui import _METADATA, layout
+
+SEARCH_STYLE = "black on yellow"
+
+# image formats that we can display, in order of preference
+IMAGE_MIMETYPES = {
+        "png": "image/png",
+        "jpeg": "image/jpeg",
+        "gif": "image/gif",
+        "svg": "image/svg+xml",
+        }
+
+# number of zoom levels for images, each half the size of the previous one.
+# The smallest one is used for the overview.
+ZOOM_LEVELS = 4
+
+# errors raised for images that can't be read: PIL raises OSError for data
+# it doesn't recognise, bad base64 raises ValueError, and svgs that aren't
+# valid xml raise ElementTree.ParseError, which is a SyntaxError
+IMAGE_ERRORS = (OSError, ValueError, SyntaxError,
+                Image.DecompressionBombError)
+
+_IMAGE_POOL = ThreadPoolExecutor(max_workers=2)
+# decoded images, keyed by (for_compare, fmt, px_sizes). Entries live as
+# long as some cell holds on to them, so reparsing a notebook reuses the
+# images of the cells it replaces, however many there are.
+_PYRAMIDS = WeakValueDictionary()
+
+# number of characters at the end of a cell's text that are kept, to check
+# that new text extends the cell without comparing all of it
+TAIL_LEN = 64
+
+# number of collapsed streams to remember, so that reparsing the notebook
+# doesn't collapse the same output again
+COLLAPSE_CACHE_SIZE = 64
+# keyed by the hash and length of the raw text rather than the text itself,
+# which can be huge, so that only the collapsed lines are kept alive
+_COLLAPSED = OrderedDict()
+
+def split_lines(text):
+    """
+    Splits {text} into lines, keeping the newlines. Unlike str.splitlines,
+    only \\n counts as a line break.
+    """
+    lines = [line + "\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
 
 class BlankCell:
     pad = False
@@ -26,26 +87,117 @@ class BlankCell:
     def compare(self, cell):
         return True
 
-class TextCell:
+class CroppedCell:
+    """
+    A cell with the first {rows} rows of its render cut off, for when the
+    top of the screen falls in the middle of a wrapped line.
+    """
     pad = True
 
-    def __init__(self, text):
-        self.for_compare = hash("".join(text))
+    def __init__(self, cell, rows):
+        self.cell = cell
+        self.rows = rows
+        self.n_lines = cell.n_lines - rows
+
+    def render(self, notebook):
+        return layout.SkipRows(self.cell.render(notebook), self.rows)
 
-        self.n_lines = len(text) + 3
-        # to ensure blank lines get rendered correctly,
-        # replace a blank line with a single space
-        self.text_lines = text
-        self.text = "".join((t if t != "\n" else " \n" for t in text))
+class TextCell:
+    pad = True
+    tab_size = 8
+
+    def __init__(self, text, lines=None):
+        # nbformat allows multiline strings to be stored either as a list of
+        # lines, or as a single string
+        if not isinstance(text, str):
+            text = "".join(text)
+        self.for_compare = hash(text)
+        self.text_len = len(text)
+        self.tail = text[-TAIL_LEN:]
+
+        # {lines} can be passed in when the text has already been split up
+        if lines is None:
+            lines = split_lines(text)
+        self.text_lines = lines
+        self._text = None
+
+    @property
+    def text(self):
+        # only built once the cell is rendered, since streams being followed
+        # are replaced by a new cell every time they grow
+        if self._text is None:
+            # to ensure blank lines get rendered correctly,
+            # replace a blank line with a single space
+            self._text = "".join((t if t != "\n" else " \n"
+                                  for t in self.text_lines))
+        return self._text
+
+    @property
+    def n_lines(self):
+        # the rule above the cell, and the padding around it
+        return self.height() + 3
+
+    def height(self):
+        # empty cells still render as one blank row
+        return max(layout.line_offsets(self)[-1], 1)
+
+    def line_row(self, i):
+        """
+        Returns the row of the cell's render that line {i} starts on.
+        """
+        return layout.line_offsets(self)[i]
+
+    def display_lines(self, start=0):
+        return [line.rstrip("\n").expandtabs(self.tab_size)
+                for line in self.text_lines[start:]]
 
     def truncate(self, offset):
         if offset >= self.n_lines - 1:
             return BlankCell(1)
-        idx = max(offset - 2, 0)
-        truncated_lines = self.text_lines[idx:]
-        return type(self)(truncated_lines)
+
+        rows = max(offset - 2, 0)
+        offsets = layout.line_offsets(self)
+        idx = bisect_right(offsets, rows) - 1
+        lines = self.text_lines[idx:]
+        truncated = type(self)("".join(lines), lines)
+        if rows > offsets[idx]:
+            # the top of a wrapped line is cut off
+            return CroppedCell(truncated, rows - offsets[idx])
+        return truncated
+
+    def extends(self, text):
+        """
+        Returns whether {text} is the text of this cell, with more appended.
+        """
+        return (len(text) >= self.text_len and
+                text.startswith(self.tail, self.text_len - len(self.tail)))
+
+    def extend(self, text):
+        """
+        Returns a new cell for {text}, which has to be the text of this cell
+        with more appended to it. Only the new text is split into lines.
+        """
+        new_text = text[self.text_len:]
+        lines = list(self.text_lines)
+        if lines and not lines[-1].endswith("\n"):
+            new_text = lines.pop() + new_text
+        kept = len(lines)
+        lines.extend(split_lines(new_text))
+
+        cell = type(self)(text, lines)
+        layout.extend_offsets(cell, self, kept)
+        return cell
 
     def compare(self, cell):
+        text = TextCell._json_text(cell)
+        # comparing lengths first means that cells which have grown aren't
+        # joined up and hashed
+        if isinstance(text, str):
+            length = len(text)
+        else:
+            length = sum(map(len, text))
+        if length != self.text_len:
+            return False
         return self.for_compare == hash(TextCell.get_text_from_json(cell))
 
     def render(self, notebook):
@@ -53,35 +205,184 @@ class TextCell:
 
     @staticmethod
     def get_text_from_json(json_cell):
+        text = TextCell._json_text(json_cell)
+        if isinstance(text, str):
+            return text
+        return "".join(text)
+
+    @staticmethod
+    def _json_text(json_cell):
+        """
+        Returns the text of a json cell, either as a string or as a list of
+        lines.
+        """
         if json_cell.get("cell_type", None) in ("code", "markdown"):
-            return "".join(json_cell["source"])
+            return json_cell["source"]
 
         # must be an output cell
         if json_cell["output_type"] == "stream":
-            return "".join(json_cell["text"])
+            return json_cell["text"]
 
         # must be execute_result
         json = json_cell["data"].get("application/json", None)
         if json is not None:
             return str(json)
 
-        return "".join(json_cell["data"]["text/plain"])
+        return json_cell["data"]["text/plain"]
 
 if __name__ == "__main__":
     out = ErrorOutputCell.fix_markup("[red]hello [/][blue] world [/][/]")
 
 class MDCell(TextCell):
+    def height(self):
+        return layout.render_height(self, Markdown(self.text))
+
+    def line_row(self, i):
+        # there is no simple mapping from lines of markdown to rows, so
+        # find where line i shows up by rendering the lines before it
+        lines = split_lines(self.text)
+        return layout.render_row(
+                self, i, lambda n: Markdown("".join(lines[:n])))
+
+    def truncate(self, offset):
+        if offset >= self.n_lines - 1:
+            return BlankCell(1)
+
+        rows = max(offset - 2, 0)
+        return CroppedCell(self, rows) if rows else self
+
     def render(self, notebook):
-        return Markdown(self.text)
+        markdown = Markdown(self.text)
+        if notebook.search_pat is None:
+            return markdown
+
+        # search the rendered text rather than the source, since that is
+        # what is on screen
+        return layout.HighlightMatches(markdown, notebook.search_pat.pattern,
+                                       SEARCH_STYLE)
 
 class CodeCell(TextCell):
+    tab_size = 4
+
     def render(self, notebook):
-        return Syntax(self.text, _METADATA["language"],
-                background_color="default")
+        syntax = Syntax(self.text, _METADATA["language"],
+                background_color="default", tab_size=self.tab_size,
+                word_wrap=True)
+
+        pat = notebook.search_pat
+        if pat is None or not pat.search(self.text):
+            return syntax
+
+        # To highlight matches, we have to do the syntax highlighting
+        # ourselves, the same way that Syntax does.
+        text = syntax.highlight(self.text.expandtabs(syntax.tab_size))
+        if text.plain.endswith("\n"):
+            text.right_crop(1)
+        text.highlight_regex(pat.pattern, SEARCH_STYLE)
+        return text
+
+class StreamOutputCell(CodeCell):
+    """
+    Text written to stdout or stderr. Progress bars redraw themselves
+    thousands of times using carriage returns, so only what a terminal would
+    end up showing is kept.
+    """
+    def __init__(self, text, lines=None, cursor=0):
+        if not isinstance(text, str):
+            text = "".join(text)
+        if lines is None:
+            lines, cursor = collapse_stream(text)
+
+        # where the cursor is on the last line, if that line is unfinished
+        self.cursor = cursor
+        super().__init__(text, lines)
+
+    def extend(self, text):
+        new_text = text[self.text_len:]
+        lines = list(self.text_lines)
+        if lines and not lines[-1].endswith("\n"):
+            # pick the unfinished line up where it was left, so that
+            # carriage returns in the new text overwrite it
+            last = lines.pop()
+            new_text = last + "\r" + last[:self.cursor] + new_text
+
+        kept = len(lines)
+        # the new text is only ever seen once, so don't cache it
+        new_lines, cursor = _collapse_stream(new_text)
+        lines.extend(new_lines)
+
+        cell = StreamOutputCell(text, lines, cursor)
+        # only the new lines need to be measured
+        layout.extend_offsets(cell, self, kept)
+        return cell
+
+def collapse_stream(text):
+    """
+    Applies the carriage returns and backspaces in {text} the way a terminal
+    would, in a single pass, keeping only the final state of each line.
+
+    Returns the lines, and the position of the cursor on the last one.
+    """
+    key = (hash(text), len(text))
+    try:
+        value = _COLLAPSED[key]
+        _COLLAPSED.move_to_end(key)
+    except KeyError:
+        value = _collapse_stream(text)
+        _COLLAPSED[key] = value
+        if len(_COLLAPSED) > COLLAPSE_CACHE_SIZE:
+            _COLLAPSED.popitem(last=False)
+    return value
+
+def _collapse_stream(text):
+    lines = []
+    cursor = 0
+    for line in text.split("\n"):
+        line, cursor = collapse_line(line)
+        lines.append(line + "\n")
+
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+        cursor = 0
+    return tuple(lines), cursor
+
+def collapse_line(line):
+    if "\b" in line:
+        buf = []
+        cursor = 0
+        for char in line:
+            if char == "\r":
+                cursor = 0
+            elif char == "\b":
+                cursor = max(cursor - 1, 0)
+            elif cursor < len(buf):
+                buf[cursor] = char
+                cursor += 1
+            else:
+                buf.append(char)
+                cursor += 1
+        return "".join(buf), cursor
+
+    if "\r" not in line:
+        return line, len(line)
+
+    # Each write after a carriage return overwrites the start of the line.
+    # Going backwards, an earlier write only shows where it is longer than
+    # everything written after it.
+    writes = line.split("\r")
+    result = writes[-1]
+    for write in reversed(writes[:-1]):
+        if len(write) > len(result):
+            result += write[len(result):]
+    return result, len(writes[-1])
 
 class TextOutputCell(TextCell):
     def render(self, notebook):
-        return Text(self.text)
+        text = Text(self.text)
+        if notebook.search_pat is not None:
+            text.highlight_regex(notebook.search_pat.pattern, SEARCH_STYLE)
+        return text
 
 class ErrorOutputCell:
     ANSI_COLOR_DICT = {
@@ -125,18 +426,42 @@ class ErrorOutputCell:
             self.traceback = traceback
 
         self.tb_text = "\n".join(self.traceback)
-        self.n_lines = len(self.traceback) + 3
+
+    @property
+    def n_lines(self):
+        return layout.line_offsets(self)[-1] + 3
+
+    def display_lines(self):
+        return Text.from_markup(self.tb_text).plain.split("\n")
+
+    def line_row(self, i):
+        """
+        Returns the row of the cell's render that line {i} starts on.
+        """
+        return layout.line_offsets(self)[i]
 
     def truncate(self, offset):
-        idx = max(offset - 2, 0)
-        return ErrorOutputCell(self.traceback[idx:], needs_processing=False)
+        if offset >= self.n_lines - 1:
+            return BlankCell(1)
+
+        rows = max(offset - 2, 0)
+        offsets = layout.line_offsets(self)
+        idx = bisect_right(offsets, rows) - 1
+        truncated = ErrorOutputCell(self.traceback[idx:],
+                                    needs_processing=False)
+        if rows > offsets[idx]:
+            return CroppedCell(truncated, rows - offsets[idx])
+        return truncated
 
     def compare(self, other):
         other_text = "".join(other["traceback"])
         return self.for_compare == hash(other_text)
 
     def render(self, notebook):
-        return Text.from_markup(self.tb_text)
+        text = Text.from_markup(self.tb_text)
+        if notebook.search_pat is not None:
+            text.highlight_regex(notebook.search_pat.pattern, SEARCH_STYLE)
+        return text
 
     @staticmethod
     def fix_markup(text):
@@ -161,18 +486,27 @@ class ErrorOutputCell:
         return text
 
 class DisplayOutputCell:
-    def __init__(self, b64_data, fmt):
-        self.for_compare = hash(b64_data)
-
-        # strip off the final newline
-        b64 = b64_data.encode("ascii")[:-1]
-        self.b64 = b64
+    def __init__(self, data, fmt):
+        if not isinstance(data, str):
+            data = "".join(data)
+        self.for_compare = hash(data)
         self.fmt = fmt
-
-        # note - PIL sizes are (width x height)
-        self.img = Image.open(io.BytesIO(decodebytes(b64)))
-        width = self.img.size[0]
-        height = self.img.size[1]
+        # visible rows of the image, in pixels. Truncating a cell only moves
+        # these bounds, and the terminal does the cropping for us, so the
+        # image never has to be re-encoded while scrolling.
+        self.crop = None
+
+        if fmt == "svg":
+            raw = data.encode("utf-8")
+            width, height = svg_size(raw)
+            b64 = None
+        else:
+            # strip off the final newline
+            b64 = data.encode("ascii").rstrip(b"\n")
+            raw = decodebytes(b64)
+            # note - PIL sizes are (width x height). Opening an image only
+            # reads its header, so this is cheap.
+            width, height = Image.open(io.BytesIO(raw)).size
 
         if (width >= (_METADATA["term_width"] / 1.5) *
                 _METADATA["pix_per_col"] or 
@@ -183,53 +517,192 @@ class DisplayOutputCell:
                                      _METADATA["pix_per_col"]))
             height = min(height, floor((_METADATA["term_height"] / 1.5) *
                                        _METADATA["pix_per_row"]))
-            self.img = self.img.resize((width, height))
-            self.b64 = self.img_to_b64(self.img)
+            # the original data no longer matches what we display; the
+            # transmission code will send raw pixels instead
+            b64 = None
+
+        if fmt != "png":
+            # kitty only understands png, so anything else goes out as
+            # raw pixels
+            b64 = None
+        self._b64 = b64
+
+        # size of the image at each zoom level, each half the previous one
+        self.px_sizes = tuple((ceil(width / 2 ** level),
+                               ceil(height / 2 ** level))
+                              for level in range(ZOOM_LEVELS))
+        # decoding, resizing and building the smaller zoom levels all
+        # happen off the UI thread
+        key = (self.for_compare, fmt, self.px_sizes)
+        self._pyramid = _PYRAMIDS.get(key)
+        if self._pyramid is None:
+            self._pyramid = _IMAGE_POOL.submit(load_pyramid, raw, fmt,
+                                               self.px_sizes)
+            _PYRAMIDS[key] = self._pyramid
 
-        self.size = (ceil(height / _METADATA["pix_per_row"]),
-                     ceil(width / _METADATA["pix_per_col"]))
-        self.n_lines = self.size[0] + 5
         self.pad = True
 
+    @property
+    def b64(self):
+        # the original png only matches the largest zoom level
+        return self._b64 if zoom_level() == 0 else None
+
+    @property
+    def px_size(self):
+        return self.px_sizes[zoom_level()]
+
+    @property
+    def img(self):
+        return self._pyramid.result()[zoom_level()]
+
+    @property
+    def size(self):
+        top, bottom = self.visible_rows()
+        return (ceil((bottom - top) / _METADATA["pix_per_row"]),
+                ceil(self.px_size[0] / _METADATA["pix_per_col"]))
+
+    @property
+    def n_lines(self):
+        return self.size[0] + 5
+
+    def ready(self):
+        return self._pyramid.done()
+
+    def failed(self):
+        """
+        Whether the image couldn't be decoded, in which case it is never
+        drawn.
+        """
+        return self.ready() and self._pyramid.exception() is not None
+
+    def wait(self):
+        """
+        Blocks until the image has been decoded, or has failed to.
+        """
+        self._pyramid.exception()
+
+    def when_ready(self, callback):
+        self._pyramid.add_done_callback(lambda _: callback())
+
+    def _cropped(self, top, bottom):
+        cell = copy(self)
+        cell.crop = (top, bottom)
+        return cell
+
+    def visible_rows(self):
+        if self.crop is None:
+            return (0, self.px_size[1])
+        return self.crop
+
     def truncate(self, offset):
         if offset <= 2:
             return self
         if offset >= self.n_lines - 4:
             return BlankCell(self.n_lines - offset)
 
+        top, bottom = self.visible_rows()
         offset_in_px = ceil((offset - 2) * _METADATA["pix_per_row"])
-        new_img = self.img.crop((0, offset_in_px,
-            self.img.size[0], self.img.size[1]))
-
-        new_data = DisplayOutputCell.img_to_b64(new_img).decode("utf-8") + "\n"
-        return DisplayOutputCell(new_data, self.fmt)
+        return self._cropped(min(top + offset_in_px, bottom - 1), bottom)
 
     def truncate_bottom(self, offset):
         if offset <= 4:
             return BlankCell(1)
         
+        top, bottom = self.visible_rows()
         offset_in_px = ceil((offset - 4) * _METADATA["pix_per_row"])
-
-        new_img = self.img.crop((0, 0, self.img.size[0],
-            offset_in_px))
-
-        new_data = DisplayOutputCell.img_to_b64(new_img).decode("utf-8") + "\n"
-        return DisplayOutputCell(new_data, self.fmt)
+        return self._cropped(top, min(top + offset_in_px, bottom))
 
     def compare(self, other):
-        return self.for_compare == hash(other["data"]["image/png"])
+        data = other["data"].get(IMAGE_MIMETYPES[self.fmt])
+        if data is not None and not isinstance(data, str):
+            data = "".join(data)
+        return self.for_compare == hash(data)
 
     def render(self, notebook):
+        if self.failed():
+            # take up the same space as the image would have, so that
+            # nothing below it moves
+            return Syntax("[could not display image]\n" +
+                          " \n" * (self.n_lines - 4), "text",
+                          background_color="default")
+
         # first draw a blank canvas for the image to sit on top of, and then
         # register the image to be drawn later.
         # notebook.draw_plot_later(self, max(3, 5 - (start - k)))
         return Syntax(" \n" * (self.n_lines - 3), "python",
             background_color="default")
 
-    @staticmethod
-    def img_to_b64(img):
-        stream = io.BytesIO()
-        img.save(stream, format="png")
-        return b64encode(stream.getvalue())
-
-
+    def raw_pixels(self):
+        """
+        Returns the decoded pixels of the image, along with the matching
+        kitty graphics format code (24 for RGB, 32 for RGBA).
+        """
+        img = self.img
+        return img.tobytes(), 32 if img.mode == "RGBA" else 24
+
+def zoom_level():
+    return _METADATA.get("zoom", 0)
+
+def load_pyramid(data, fmt, sizes):
+    """
+    Decodes an image once, at the largest of {sizes}, and then repeatedly
+    halves it to build the smaller zoom levels.
+    """
+    levels = [load_image(data, fmt, sizes[0])]
+    for size in sizes[1:]:
+        img = levels[-1].reduce(2)
+        if img.size != size:
+            img = img.resize(size)
+        levels.append(img)
+
+    return tuple(levels)
+
+def load_image(data, fmt, size):
+    """
+    Decodes an image, and scales it to {size}. The result is always in RGB or
+    RGBA mode, so that it can be sent straight to the terminal.
+    """
+    if fmt == "svg":
+        data = cairosvg.svg2png(bytestring=data, output_width=size[0],
+                                output_height=size[1])
+
+    img = Image.open(io.BytesIO(data))
+    if fmt == "jpeg":
+        # let the decoder do most of the downscaling, which is much
+        # faster than decoding at full size and resizing afterwards
+        img.draft("RGB", size)
+    # for animated gifs, only the first frame is shown
+
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        img = img.convert("RGBA")
+    else:
+        img = img.convert("RGB")
+
+    if img.size != size:
+        img = img.resize(size)
+
+    return img
+
+def svg_size(data):
+    """
+    Returns the size of an svg image in pixels, as (width x height).
+    """
+    root = ElementTree.fromstring(data)
+
+    def to_px(length):
+        match = re.match(r"\s*([0-9.]+)\s*(px|pt)?\s*$", length or "")
+        if match is None:
+            return None
+        value = float(match.group(1))
+        return value * 4 / 3 if match.group(2) == "pt" else value
+
+    width = to_px(root.get("width"))
+    height = to_px(root.get("height"))
+    if width is None or height is None:
+        try:
+            _, _, width, height = map(float,
+                    root.get("viewBox", "").replace(",", " ").split())
+        except ValueError:
+            width, height = 640, 480
+
+    return ceil(width), ceil(height)
@@ -1,5 +1,17 @@
 from base64 import standard_b64encode
+from bisect import bisect_right
+from functools import partial
+from itertools import count
+import os
 import sys
+import tempfile
+import zlib
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
 
 import rich
 from rich.console import RenderGroup
@@ -26,8 +38,18 @@ class Notebook:
         # which line is currently at the top
         self.row = 0
         self.search_pat = None
+        # the search prompt, while it is open
+        self.search = None
         self.needs_redraw = False
 
+        self.layout(cells)
+
+    def layout(self, cells):
+        """
+        Work out which row each cell starts on.
+        """
+        self.cell_displays = {}
+        self.cell_renders = {}
         display_row = 0
 
         for cell in cells:
@@ -42,7 +64,8 @@ class Notebook:
         # Therefore, add an artificial empty cell to ensure that
         # the size of the notebook exceeds the terminal height.
 
-        if display_row < _METADATA["term_height"]:
+        self.padded = display_row < _METADATA["term_height"]
+        if self.padded:
             dummy_text = ["\n" for _ in range(_METADATA["term_height"] - 
                                               display_row + 1)]
             dummy_cell = CodeCell(dummy_text)
@@ -50,17 +73,82 @@ class Notebook:
             self.cell_renders[display_row] = None
 
         self.size = max(display_row, _METADATA["term_height"])
+        self.free_images()
+
+    def relayout(self):
+        """
+        Lay the notebook out again after the terminal has been resized,
+        keeping the same line at the top of the screen. Only cells whose
+        height at the new width isn't cached are measured.
+        """
+        rows = list(self.cell_displays)
+        cells = list(self.cell_displays.values())
+        if self.padded:
+            rows.pop()
+            cells.pop()
+
+        idx = max(bisect_right(rows, self.row) - 1, 0)
+        offset = self.row - rows[idx] if rows else 0
+
+        self.layout(cells)
+        if cells:
+            new_row = list(self.cell_displays)[idx]
+            self.row = new_row + min(offset, cells[idx].n_lines - 1)
+            self.row = min(self.row, self.size + 2 - _METADATA["term_height"])
+        self.needs_redraw = True
+
+    def set_search_pat(self, pat):
+        if pat is self.search_pat:
+            return
+        self.search_pat = pat
+        # matches are highlighted in the renders
+        self.cell_renders = {}
+        self.needs_redraw = True
 
     def draw_plot_later(self, cell, start_row):
-        self.plots_todraw.append((cell.b64,
+        self.plots_todraw.append((cell,
             (start_row, int((_METADATA["term_width"] - cell.size[1]) / 2)),
             cell.size))
 
-    def draw_plots(self):
-        for (image, pos, size) in self.plots_todraw:
-            display_image(image, pos, size)
+    def request_redraw(self):
+        self.needs_redraw = True
+
+    def free_images(self):
+        """
+        Frees the images in the terminal that no cell shows any more, e.g.
+        after the notebook changed, or after a resize or zoom.
+        """
+        clear_images({image_key(cell)
+                      for cell in self.cell_displays.values()
+                      if isinstance(cell, DisplayOutputCell)})
+
+    def image_ready(self, cell):
+        if cell.failed():
+            # the blank canvas rendered for it is replaced by a message
+            self.cell_renders = {}
+        self.request_redraw()
+
+    def draw_plots(self, wait_images=False):
+        """
+        Draws the plots registered while rendering, and returns the ones that
+        were skipped because they are still being decoded. With
+        {wait_images}, waits for them to be decoded instead.
+        """
+        pending = []
+        for (cell, pos, size) in self.plots_todraw:
+            if wait_images:
+                cell.wait()
+            if cell.failed():
+                continue
+            if cell.ready():
+                display_image(cell, pos, size)
+            else:
+                # draw it as soon as it has been decoded
+                cell.when_ready(partial(self.image_ready, cell))
+                pending.append(cell)
 
         self.plots_todraw.clear()
+        return pending
 
     def get_renders_in_range(self, start, end):
         """
@@ -74,7 +162,7 @@ class Notebook:
                 # only part of the cell is showing
                 truncated_cell = v.truncate(start - k)
 
-                renderable = truncated_cell.render(-1)
+                renderable = truncated_cell.render(self)
 
                 if truncated_cell.pad:
                     renderable = pad_renderable(renderable, start - k)
@@ -88,7 +176,7 @@ class Notebook:
             elif k >= start and k <= end:
                 if self.cell_renders.get(k, None) is None:
                     self.cell_renders[k] = pad_renderable(
-                            self.cell_displays[k].render(-1), 0)
+                            self.cell_displays[k].render(self), 0)
 
                 renders.append(self.cell_renders[k])
 
@@ -116,6 +204,33 @@ def display_notebook(notebook):
 
     return Panel(RenderGroup(*renders))
 
+def redraw(live, notebook, wait_images=False):
+    """
+    Clears the screen, and draws the notebook, its plots and the search
+    prompt. Returns the plots that are still being decoded, which will be
+    drawn by a later redraw, unless {wait_images} is set.
+    """
+    rendered_cells = display_notebook(notebook)
+
+    sys.stdout.buffer.write(b"\x1b[2J\x1b[H")
+    live.update(rendered_cells, refresh=True)
+    pending = notebook.draw_plots(wait_images)
+    display_prompt(notebook)
+    return pending
+
+def display_prompt(notebook):
+    """
+    Draws the search prompt on the bottom line of the screen, if it is open.
+    """
+    prompt = notebook.search
+    if prompt is None or not prompt.editing:
+        return
+
+    prefix = "/" if prompt.forward else "?"
+    sys.stdout.buffer.write(b'\033[999;1H\033[K' +
+                            (prefix + prompt.query).encode("utf-8"))
+    sys.stdout.flush()
+
 def pad_renderable(renderable, offset):
     """
     Pad a renderable, subject to a particular truncation offset.
@@ -129,27 +244,156 @@ def pad_renderable(renderable, offset):
     else:
         return Padding(renderable, (0, 1, 1, 1))
 
-def display_image(image, position, size):
+# id used for the image in the startup query, so that it can't clash with
+# the ids of real images
+QUERY_ID = 31
+
+# ids of images which have already been sent to the terminal, keyed by the
+# image and the size it was sent at. Each image is only transmitted once,
+# and after that the terminal is just told where to place it again.
+_TRANSMITTED = {}
+_IMAGE_IDS = count(QUERY_ID + 1)
+
+def display_image(cell, position, size):
     """
-    Takes a base 64 encoded image string, and displays it on the screen
-    using the kitty graphics protocol.
+    Displays an image cell on the screen using the kitty graphics protocol.
+
+    The first time an image is displayed, it is transmitted using the medium
+    in _METADATA["transmission"]: "shm" and "file" hand kitty the raw pixels
+    through POSIX shared memory or a temporary file, which only works when
+    kitty runs on the same machine, and "direct" sends the image inline as
+    base64. After that, the image is only placed again using its id.
+    Everything for one image goes out in a single write.
     """
+    key = image_key(cell)
+    image_id = _TRANSMITTED.get(key)
+    payload = b''
+    if image_id is None:
+        image_id = next(_IMAGE_IDS)
+        payload = _transmit(cell, image_id)
+        _TRANSMITTED[key] = image_id
+
+    # q=2 stops the terminal from replying, since replies would show up on
+    # stdin as keypresses
+    cmd = {"a": "p", "i": image_id, "r": size[0], "c": size[1], "q": 2}
+
+    top, bottom = cell.visible_rows()
+    if (top, bottom) != (0, cell.px_size[1]):
+        cmd.update({"x": 0, "y": top,
+                    "w": cell.px_size[0], "h": bottom - top})
+
     # move cursor
-    sys.stdout.buffer.write(b'\033[%d;%dH' % position)
+    sys.stdout.buffer.write(b'\033[%d;%dH' % position + payload +
+                            _graphics_command(cmd, b''))
+    sys.stdout.flush()
 
-    cmd = {"a": "T", "f": 100,  "r": size[0], "c":size[1]}
+def image_key(cell):
+    return (cell.for_compare, cell.px_size)
 
-    while image:
-        chunk, image = image[:4096], image[4096:]
+def clear_images(keep=()):
+    """
+    Frees the images that were sent to the terminal, except for those whose
+    image_key is in {keep}. Images that are no longer shown have to be
+    freed, or kitty evicts images once it runs out of space, including ones
+    we would still place by id.
+    """
+    freed = [key for key in _TRANSMITTED if key not in keep]
+    if not freed:
+        return
+
+    for key in freed:
+        cmd = {"a": "d", "d": "I", "i": _TRANSMITTED.pop(key), "q": 2}
+        sys.stdout.buffer.write(_graphics_command(cmd, b''))
+    sys.stdout.flush()
 
-        m = 1 if image else 0
-        cmd["m"] = m
+def image_query(medium):
+    """
+    Returns a kitty graphics query asking the terminal to load a 1x1 image
+    through {medium}, and a function that removes the shared memory segment
+    or file afterwards, in case the terminal never read it.
+    """
+    cmd = {"a": "q", "i": QUERY_ID, "f": 24, "s": 1, "v": 1}
+    query, name = _transmit_raw(medium, b'\0\0\0', cmd)
+
+    if medium == "shm":
+        cleanup = partial(_unlink_shm, name)
+    else:
+        cleanup = partial(_remove_file, name)
+    return query, cleanup
+
+def _graphics_command(cmd, data):
+    cmd_header = ','.join(f'{k}={v}' for k, v in cmd.items())
+    cmd_header = cmd_header.encode("ascii")
+    return b''.join((b'\033_G', cmd_header, b';', data, b'\033\\'))
+
+def _transmit(cell, image_id):
+    cmd = {"a": "t", "i": image_id, "q": 2}
+    medium = _METADATA.get("transmission", "direct")
 
-        cmd_header = ','.join(f'{k}={v}' for k, v in cmd.items())
-        cmd_header = cmd_header.encode("ascii")
-        payload = b''.join((b'\033_G', cmd_header, b';', chunk, b'\033\\'))
+    if medium == "direct" and cell.b64 is not None:
+        # the original png from the notebook can be sent as-is
+        cmd["f"] = 100
+        return _direct_chunks(cell.b64, cmd)
 
-        sys.stdout.buffer.write(payload)
-        sys.stdout.flush()
+    data, fmt = cell.raw_pixels()
+    cmd.update({"f": fmt, "s": cell.px_size[0], "v": cell.px_size[1]})
+    return _transmit_raw(medium, data, cmd)[0]
+
+def _transmit_raw(medium, data, cmd):
+    """
+    Returns the command transmitting raw pixels through {medium}, and the
+    name of the shared memory segment or file that it refers to.
+    """
+    if medium == "shm":
+        name = _write_shm(data)
+        cmd.update({"t": "s", "S": len(data)})
+        return _graphics_command(cmd, standard_b64encode(name.encode())), name
+    if medium == "file":
+        path = _write_file(data)
+        cmd.update({"t": "t", "S": len(data)})
+        return _graphics_command(cmd, standard_b64encode(path.encode())), path
+
+    cmd["o"] = "z"
+    image = standard_b64encode(zlib.compress(data, 1))
+    return _direct_chunks(image, cmd), None
+
+def _direct_chunks(image, cmd):
+    chunks = []
+    while image:
+        chunk, image = image[:4096], image[4096:]
 
-        cmd.clear()
+        cmd["m"] = 1 if image else 0
+        chunks.append(_graphics_command(cmd, chunk))
+        # the following chunks may only repeat the quiet flag
+        cmd = {"q": cmd["q"]} if "q" in cmd else {}
+
+    return b''.join(chunks)
+
+def _write_shm(data):
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    # kitty unlinks the segment once it has read it, so make sure python
+    # doesn't try to clean it up (and complain about it) on exit.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return shm._name
+
+def _write_file(data):
+    # kitty only deletes temporary files which have this in their name
+    fd, path = tempfile.mkstemp(prefix="tty-graphics-protocol-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return path
+
+def _unlink_shm(name):
+    try:
+        # python adds the leading slash back itself
+        shared_memory.SharedMemory(name=name.lstrip("/")).unlink()
+    except FileNotFoundError:
+        pass
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
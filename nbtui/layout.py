@@ -0,0 +1,165 @@
+"""
+Measures how many rows cells take up on screen, at the current terminal
+width. Heights are computed the first time they are asked for, and cached by
+(cell, width), so that resizing or editing the notebook only measures the
+cells that actually changed.
+"""
+from collections import OrderedDict
+from functools import lru_cache
+import io
+
+from rich.cells import cell_len
+from rich.console import Console
+from rich.segment import Segment
+from rich.text import Text
+
+from nbtui import _METADATA
+
+# columns taken up by the border and padding of the notebook panel, and the
+# padding around each cell
+MARGIN = 6
+# number of (cell, width) pairs to remember heights for
+CACHE_SIZE = 8192
+
+_HEIGHTS = OrderedDict()
+_CONSOLE = Console(file=io.StringIO())
+
+def content_width():
+    return max(_METADATA["term_width"] - MARGIN, 1)
+
+def _key(cell, *extra):
+    return (type(cell), cell.for_compare, content_width()) + extra
+
+def _cached(cell, compute, *extra):
+    key = _key(cell, *extra)
+    try:
+        value = _HEIGHTS[key]
+        _HEIGHTS.move_to_end(key)
+    except KeyError:
+        value = compute(key[2])
+        _store(key, value)
+    return value
+
+def _store(key, value):
+    _HEIGHTS[key] = value
+    if len(_HEIGHTS) > CACHE_SIZE:
+        _HEIGHTS.popitem(last=False)
+
+@lru_cache(maxsize=65536)
+def line_rows(line, width):
+    """
+    Number of rows a single line of text takes up, once wrapped to {width}.
+    """
+    if cell_len(line) <= width:
+        return 1
+    return len(Text(line).wrap(_CONSOLE, width))
+
+def line_offsets(cell):
+    """
+    For cells made up of lines of text, returns the row each line starts on,
+    so that offsets[i] is the first row of line i, and offsets[-1] is the
+    height of the cell. Lines are measured on their own, without rendering
+    the cell.
+    """
+    def compute(width):
+        return _measure_lines(cell.display_lines(), width, [0])
+
+    return _cached(cell, compute)
+
+def extend_offsets(cell, old_cell, kept):
+    """
+    Works out the offsets of {cell}, whose first {kept} lines are the same as
+    those of {old_cell}, by only measuring the lines after them. Does nothing
+    if the offsets of {old_cell} aren't known at the current width.
+    """
+    old_offsets = _HEIGHTS.get(_key(old_cell))
+    if old_offsets is None:
+        return
+
+    offsets = old_offsets[:kept + 1]
+    _store(_key(cell), _measure_lines(cell.display_lines(kept),
+                                      content_width(), offsets))
+
+def _measure_lines(lines, width, offsets):
+    row = offsets[-1]
+    for line in lines:
+        # no character is more than two columns wide, so short lines can't
+        # wrap, and don't need to be looked up
+        row += 1 if 2 * len(line) <= width else line_rows(line, width)
+        offsets.append(row)
+    return offsets
+
+def render_height(cell, renderable):
+    """
+    Height of a cell whose layout can't be worked out line by line
+    (e.g. markdown), found by rendering it.
+    """
+    def compute(width):
+        options = _CONSOLE.options.update(width=width)
+        return len(_CONSOLE.render_lines(renderable, options, pad=False))
+
+    return _cached(cell, compute)
+
+def render_row(cell, i, render):
+    """
+    Row that line {i} of a cell starts on, for cells whose layout can't be
+    worked out line by line. {render(n)} should return a renderable for the
+    first n lines of the cell, and line {i} starts on the first row where
+    the renders with and without it differ. When line {i} starts a new
+    block, the rows added for it start with the blank rows separating it
+    from the block before, which are skipped.
+    """
+    def compute(width):
+        before = _render_plain(render(i), width)
+        after = _render_plain(render(i + 1), width)
+        for row, (a, b) in enumerate(zip(before, after)):
+            if a != b:
+                return row
+        for row in range(len(before), len(after)):
+            if after[row]:
+                return row
+        # line {i} didn't change anything on screen, e.g. a blank line
+        return min(len(before), max(len(after) - 1, 0))
+
+    return _cached(cell, compute, i)
+
+def _render_plain(renderable, width):
+    options = _CONSOLE.options.update(width=width)
+    lines = _CONSOLE.render_lines(renderable, options, pad=False)
+    return ["".join(segment.text for segment in line).rstrip()
+            for line in lines]
+
+class SkipRows:
+    """
+    Renders {renderable} with its first {rows} rows cut off.
+    """
+    def __init__(self, renderable, rows):
+        self.renderable = renderable
+        self.rows = rows
+
+    def __rich_console__(self, console, options):
+        lines = console.render_lines(self.renderable, options, pad=False)
+        for line in lines[self.rows:]:
+            yield from line
+            yield Segment.line()
+
+class HighlightMatches:
+    """
+    Renders {renderable}, highlighting everything on screen that matches
+    {pattern} with {style}. Matches are found line by line, so they can't
+    span rows.
+    """
+    def __init__(self, renderable, pattern, style):
+        self.renderable = renderable
+        self.pattern = pattern
+        self.style = style
+
+    def __rich_console__(self, console, options):
+        lines = console.render_lines(self.renderable, options, pad=False)
+        for line in lines:
+            text = Text(end="")
+            for segment in line:
+                text.append(segment.text, segment.style)
+            text.highlight_regex(self.pattern, self.style)
+            yield from text.render(console, end="")
+            yield Segment.line()
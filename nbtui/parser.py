@@ -1,5 +1,6 @@
 import logging
 
+import nbtui.display
 from nbtui import _METADATA
 from nbtui.cells import *
 
@@ -29,20 +30,29 @@ def parse_nb_cell(cell):
 
 def parse_nb_output(output):
     if output["output_type"] == "stream":
-        return CodeCell(output["text"])
+        return StreamOutputCell(output["text"])
     elif output["output_type"] == "error":
       return ErrorOutputCell(output["traceback"])
     elif output["output_type"] == "display_data":
         im = try_parse_image(output)
         if im is not None:
-          return DisplayOutputCell(im, "png")
+            cell = parse_image(*im)
+            if cell is not None:
+                return cell
 
-        # if there is no png, just return a blank line
+            # the image is broken, so show its text instead, if it has any
+            text = output["data"].get("text/plain", None)
+            if text is not None:
+                return TextOutputCell(text)
+
+        # if there is no image, just return a blank line
         return BlankCell(1)
     elif output["output_type"] == "execute_result":
         im = try_parse_image(output)
         if im is not None:
-            return DisplayOutputCell(im, "png")
+            cell = parse_image(*im)
+            if cell is not None:
+                return cell
 
         json = output["data"].get("application/json", None)
         if json is not None:
@@ -116,8 +126,134 @@ def reparse_nb(json_notebook, parsed_notebook):
 
     return parsed_notebook
 
+def follow_nb(json_notebook, parsed_notebook):
+    """
+    A cheaper version of reparse_nb, for notebooks that are being executed.
+
+    Only the span of cells between the unchanged start and the unchanged end
+    of the notebook is parsed, and the renders of everything else are kept.
+    If that span is a stream output which only had text appended to it,
+    only the new text is parsed.
+    """
+    if parsed_notebook.padded:
+        return reparse_nb(json_notebook, parsed_notebook)
+
+    old_cells = list(parsed_notebook.cell_displays.items())
+    new_cells = list(flatten_nb(json_notebook))
+
+    n_common = min(len(old_cells), len(new_cells))
+    prefix = 0
+    while (prefix < n_common and
+           _same_cell(old_cells[prefix][1], new_cells[prefix])):
+        prefix += 1
+
+    suffix = 0
+    while (suffix < n_common - prefix and
+           _same_cell(old_cells[-1 - suffix][1], new_cells[-1 - suffix])):
+        suffix += 1
+
+    if prefix == len(old_cells) == len(new_cells):
+        # nothing that we display has changed
+        return parsed_notebook
+
+    changed_old = old_cells[prefix:len(old_cells) - suffix]
+    changed_new = new_cells[prefix:len(new_cells) - suffix]
+
+    parsed = []
+    if changed_old and changed_new:
+        # the common case while executing: a stream output has grown
+        old_cell = changed_old[-1][1]
+        kind, json_cell = changed_new[0]
+        if (len(changed_old) == 1 and kind == "output" and
+                json_cell["output_type"] == "stream" and
+                isinstance(old_cell, StreamOutputCell)):
+            new_text = TextCell.get_text_from_json(json_cell)
+            if old_cell.extends(new_text):
+                parsed.append(old_cell.extend(new_text))
+                changed_new = changed_new[1:]
+
+    for kind, json_cell in changed_new:
+        if kind == "cell":
+            parsed.append(parse_nb_cell(json_cell))
+        else:
+            parsed.append(parse_nb_output(json_cell))
+
+    if prefix < len(old_cells):
+        display_row = old_cells[prefix][0]
+    else:
+        display_row = parsed_notebook.size
+    delta = (sum(cell.n_lines for cell in parsed) -
+             sum(cell.n_lines for _, cell in changed_old))
+    if parsed_notebook.size + delta < _METADATA["term_height"]:
+        # the notebook is now too small, and needs padding
+        return reparse_nb(json_notebook, parsed_notebook)
+
+    cell_displays = dict(old_cells[:prefix])
+    cell_renders = {row: render for row, render in
+                    parsed_notebook.cell_renders.items() if row < display_row}
+    for cell in parsed:
+        cell_displays[display_row] = cell
+        display_row += cell.n_lines
+    for row, cell in old_cells[len(old_cells) - suffix:]:
+        cell_displays[row + delta] = cell
+        if row in parsed_notebook.cell_renders:
+            cell_renders[row + delta] = parsed_notebook.cell_renders[row]
+
+    parsed_notebook.cell_displays = cell_displays
+    parsed_notebook.cell_renders = cell_renders
+    parsed_notebook.size += delta
+    parsed_notebook.needs_redraw = True
+
+    return parsed_notebook
+
+def flatten_nb(json_notebook):
+    """
+    Yields every cell and output of a json notebook, in display order,
+    as ("cell", json) or ("output", json) pairs.
+    """
+    for cell in json_notebook["cells"]:
+        yield "cell", cell
+        for output in cell.get("outputs", []):
+            yield "output", output
+
+def _same_cell(parsed_cell, entry):
+    kind, json_cell = entry
+    if isinstance(parsed_cell, BlankCell):
+        # BlankCell.compare matches anything
+        return (kind == "output" and
+                json_cell["output_type"] == "display_data" and
+                try_parse_image(json_cell) is None)
+    try:
+        return parsed_cell.compare(json_cell)
+    except (KeyError, TypeError):
+        # the cell has changed type
+        return False
+
+def parse_image(data, fmt):
+    """
+    Returns a cell displaying an image, or None if the image can't be read.
+    Images are only fully decoded later, and failures there are handled by
+    the cell itself.
+    """
+    try:
+        return DisplayOutputCell(data, fmt)
+    except IMAGE_ERRORS:
+        return None
+
 def try_parse_image(cell):
+    """
+    Returns the data and format of the first image in an output that we are
+    able to display, or None.
+    """
     if not _METADATA["img_support"]:
         return None
 
-    return cell["data"].get("image/png", None)
+    for fmt, mimetype in IMAGE_MIMETYPES.items():
+        data = cell["data"].get(mimetype, None)
+        if data is None:
+            continue
+        if fmt == "svg" and cairosvg is None:
+            continue
+        return data, fmt
+
+    return None
@@ -0,0 +1,298 @@
+"""
+Plays back a sequence of keypresses and file changes against a notebook,
+without a real terminal, and reports how many bytes were written and how
+long each frame took.
+
+Traces are files with one json object per line, either
+{"t": 1.5, "key": "j"} for a keypress, {"t": 2.0, "notebook": {...}} for a
+new version of the notebook file, {"t": 2.0, "reload": "path.ipynb"}
+to load a new version from disk, or
+{"t": 3.0, "size": [120, 40], "pixels": [1200, 800]} for the size of the
+terminal in cells and pixels. "t" is the time since the start of the
+session, in seconds. A size at the start of the trace sets the size of the
+fake terminal, and later ones resize it. Traces can be written by hand, or
+recorded from a real session with nbtui --record TRACE.
+
+Usage:
+    python -m nbtui.replay NOTEBOOK.ipynb --trace TRACE
+    python -m nbtui.replay NOTEBOOK.ipynb --keys 'jjjjjjjj/plot\\n'
+"""
+import argparse
+import codecs
+import io
+import json
+from math import ceil
+import sys
+import time
+
+from rich.console import Console
+from rich.live import Live
+
+from nbtui import _METADATA
+from nbtui.display import Notebook, redraw
+from nbtui.parser import parse_nb
+from nbtui.user_input import handle_file_change, handle_input
+
+# size of the fake terminal when neither the trace nor the command line
+# give one, in cells and in pixels
+DEFAULT_SIZE = (80, 24)
+DEFAULT_PIXELS = (800, 480)
+
+class TraceRecorder:
+    """
+    Records the events of a real session to a trace file.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+        self.start = time.monotonic()
+        self.record_size()
+
+    def record_size(self):
+        """
+        Records the current size of the terminal, in cells and pixels.
+        """
+        self.record(size=[_METADATA["term_width"], _METADATA["term_height"]],
+                    pixels=[_METADATA["screen_width"],
+                            _METADATA["screen_height"]])
+
+    def record(self, **event):
+        event["t"] = round(time.monotonic() - self.start, 4)
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class _CountingBuffer:
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+class FakeTerminal(io.TextIOBase):
+    """
+    Stands in for stdout, throwing away everything written to it and
+    counting the bytes.
+    """
+    def __init__(self):
+        self.buffer = _CountingBuffer()
+
+    def write(self, text):
+        self.buffer.write(text.encode("utf-8"))
+        return len(text)
+
+    def isatty(self):
+        return True
+
+    @property
+    def written(self):
+        return self.buffer.written
+
+def load_trace(filename):
+    with open(filename, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def keys_to_trace(keys):
+    """
+    Turns a string of keys, with python escapes such as \\n and \\x04
+    for C-D, into a trace.
+    """
+    keys = codecs.decode(keys, "unicode_escape")
+    return [{"t": 0, "key": key} for key in keys]
+
+def percentile(values, p):
+    values = sorted(values)
+    k = max(ceil(p / 100 * len(values)) - 1, 0)
+    return values[k]
+
+def trace_size(trace):
+    """
+    Returns the size of the terminal in cells and in pixels recorded at the
+    start of {trace}, or the defaults if there is none.
+    """
+    if trace and "size" in trace[0]:
+        return tuple(trace[0]["size"]), tuple(trace[0]["pixels"])
+    return DEFAULT_SIZE, DEFAULT_PIXELS
+
+def set_size(size, pixels):
+    _METADATA["term_width"], _METADATA["term_height"] = size
+    _METADATA["screen_width"], _METADATA["screen_height"] = pixels
+    _METADATA["pix_per_col"] = pixels[0] / size[0]
+    _METADATA["pix_per_row"] = pixels[1] / size[1]
+    _METADATA["img_support"] = pixels != (0, 0)
+
+def replay(json_notebook, trace, size=None, pixels=None,
+           follow=False, wait_images=True):
+    """
+    Plays back {trace} against {json_notebook}, on a fake terminal that is
+    {size} cells and {pixels} pixels large (both as width x height). Either
+    defaults to the size recorded at the start of the trace.
+
+    Events are played back as fast as possible, rather than at the times
+    they were recorded, and every event that causes a redraw is one frame,
+    timed from handling the event to the end of the redraw. Returns a list
+    of (latency in seconds, bytes written, plots skipped) triples, one per
+    frame, starting with the first draw.
+
+    With {wait_images}, frames wait for the images on screen to be decoded
+    before drawing them, as if decoding were part of the frame. Otherwise, plots
+    that are still being decoded are skipped and counted, and are drawn by
+    whichever frame comes after they are ready.
+
+    Images are always sent inline, since nothing would read them from shared
+    memory or temporary files.
+    """
+    recorded_size, recorded_pixels = trace_size(trace)
+    if trace and "size" in trace[0]:
+        # already applied
+        trace = trace[1:]
+    size = size or recorded_size
+    pixels = pixels or recorded_pixels
+
+    _METADATA["language"] = \
+        json_notebook["metadata"]["kernelspec"]["language"]
+    set_size(size, pixels)
+    _METADATA["transmission"] = "direct"
+
+    terminal = FakeTerminal()
+    console = Console(file=terminal, width=size[0], height=size[1],
+                      force_terminal=True)
+    frames = []
+
+    def frame(handle):
+        start = time.perf_counter()
+        written = terminal.written
+        handle()
+        if notebook.search is not None:
+            # searches run in the background, so wait for the result
+            notebook.search.wait()
+            notebook.search.poll(notebook)
+        if not notebook.needs_redraw:
+            # nothing changed on screen, so this wasn't a frame
+            return
+
+        pending = redraw(live, notebook, wait_images)
+        frames.append((time.perf_counter() - start,
+                       terminal.written - written, len(pending)))
+
+    notebook = Notebook(parse_nb(json_notebook))
+
+    stdout = sys.stdout
+    sys.stdout = terminal
+    try:
+        with Live(console=console,
+                  transient=True,
+                  auto_refresh=False,
+                  vertical_overflow="crop",
+                  redirect_stdout=False) as live:
+
+            frame(notebook.request_redraw)
+
+            for event in trace:
+                if "key" in event:
+                    frame(lambda: handle_input(event["key"], notebook))
+                    continue
+
+                if "size" in event:
+                    def resize():
+                        set_size(tuple(event["size"]), tuple(event["pixels"]))
+                        console.size = event["size"]
+                        notebook.relayout()
+                    frame(resize)
+                    continue
+
+                if "reload" in event:
+                    with open(event["reload"], "r") as f:
+                        new_nb = json.load(f)
+                else:
+                    new_nb = event["notebook"]
+
+                def change():
+                    nonlocal notebook
+                    notebook = handle_file_change(new_nb, notebook, follow)
+                frame(change)
+    finally:
+        sys.stdout = stdout
+
+    return frames
+
+def report(frames):
+    latencies = [latency for latency, _, _ in frames]
+    written = [n for _, n, _ in frames]
+    return {
+            "frames": len(frames),
+            "skipped_plots": sum(skipped for _, _, skipped in frames),
+            "bytes": sum(written),
+            "bytes_per_frame": sum(written) / len(frames),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            }
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Replay keypresses against a notebook headlessly, "
+            "and report frame latencies.")
+    parser.add_argument("filename", type=str)
+    events = parser.add_mutually_exclusive_group(required=True)
+    events.add_argument("--trace", help="trace file to play back")
+    events.add_argument("--keys", help="keys to press, e.g. 'jjjG/foo\\n'")
+    parser.add_argument("--size", type=parse_size,
+                        help="terminal size in cells, as WIDTHxHEIGHT. "
+                        "Defaults to the size recorded in the trace, or 80x24")
+    parser.add_argument("--pixels", type=parse_size,
+                        help="terminal size in pixels, as WIDTHxHEIGHT. "
+                        "0x0 disables images. Defaults to the size recorded "
+                        "in the trace, or 800x480")
+    parser.add_argument("--follow", action="store_true")
+    parser.add_argument("--no-wait-images", dest="wait_images",
+                        action="store_false",
+                        help="skip plots that are still being decoded, "
+                        "instead of waiting for them in each frame")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="play the trace back this many times")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as json")
+    args = parser.parse_args()
+
+    with open(args.filename, "r") as f:
+        nb = json.load(f)
+
+    if args.trace is not None:
+        trace = load_trace(args.trace)
+    else:
+        trace = keys_to_trace(args.keys)
+
+    if trace and "size" in trace[0]:
+        # the starting size only needs to be set once
+        trace = trace[:1] + trace[1:] * args.repeat
+    else:
+        trace = trace * args.repeat
+
+    frames = replay(nb, trace, size=args.size,
+                    pixels=args.pixels, follow=args.follow,
+                    wait_images=args.wait_images)
+    results = report(frames)
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"frames:          {results['frames']}")
+    print(f"skipped plots:   {results['skipped_plots']}")
+    print(f"bytes written:   {results['bytes']}")
+    print(f"bytes per frame: {results['bytes_per_frame']:.0f}")
+    for p in (50, 95, 99):
+        print(f"p{p} latency:     {results[f'p{p}_ms']:.2f}ms")
+
+if __name__ == "__main__":
+    main()
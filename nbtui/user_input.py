@@ -1,13 +1,17 @@
 from contextlib import contextmanager
 from functools import partial
 import os
+from queue import Queue
 import re
 import signal
 import sys
 import termios
+import threading
 
 from nbtui import _METADATA
-from nbtui.parser import TextCell
+from nbtui.cells import ZOOM_LEVELS, zoom_level
+from nbtui.parser import (ErrorOutputCell, TextCell, follow_nb,
+                          reparse_nb)
 from nbtui.display import display_notebook
 
 class SetTermAttrs:
@@ -59,68 +63,216 @@ def goto(row, notebook):
     notebook.row = row
     return False
 
+class SearchPrompt:
+    """
+    State of the search prompt, while the user is typing a query.
+
+    Every keystroke cancels the search that is currently running, and starts
+    a new one from the row where the prompt was opened in a background
+    thread, so typing never has to wait on the search. The main loop picks up
+    the results with poll().
+    """
+    def __init__(self, forward, notebook):
+        self.forward = forward
+        self.query = ""
+        self.editing = True
+        self.start_row = notebook.row
+        self.old_pat = notebook.search_pat
+
+        self._cancel = threading.Event()
+        self._generation = 0
+        self._results = Queue()
+        self._thread = None
+
+    def update(self, notebook):
+        self._cancel.set()
+        self._cancel = threading.Event()
+        self._generation += 1
+
+        if not self.query:
+            notebook.set_search_pat(None)
+            notebook.row = self.start_row
+            return
+
+        try:
+            pat = re.compile(self.query)
+        except re.error:
+            # the query is most likely still being typed, e.g. "foo(",
+            # so keep showing the last valid one
+            return
+
+        notebook.set_search_pat(pat)
+        self._thread = threading.Thread(
+                target=self._search, daemon=True,
+                args=(pat, list(notebook.cell_displays.items()),
+                      self._generation, self._cancel))
+        self._thread.start()
+
+    def _search(self, pat, cells, generation, cancel):
+        find = find_next if self.forward else find_prev
+        row = find(pat, cells, self.start_row, cancel)
+        if not cancel.is_set():
+            self._results.put((generation, row))
+
+    def cancel(self):
+        self._cancel.set()
+        self.editing = False
+
+    def wait(self):
+        """
+        Block until the current search has finished.
+        """
+        if self._thread is not None:
+            self._thread.join()
+
+    def poll(self, notebook):
+        """
+        Jump to the result of the latest search, if it has come in.
+        """
+        while not self._results.empty():
+            generation, row = self._results.get()
+            if generation != self._generation:
+                continue
+
+            goto(self.start_row if row is None else row, notebook)
+            notebook.needs_redraw = True
+            if not self.editing:
+                notebook.search = None
+
+        finished = self._thread is None or not self._thread.is_alive()
+        if not self.editing and finished and self._results.empty():
+            notebook.search = None
+
 def search(forward, notebook):
-    # place cursor at bottom of screen
-    if forward == True:
-        sys.stdout.buffer.write(b'\033[999;1H/')
-    else:
-        sys.stdout.buffer.write(b'\033[999;1H?')
+    notebook.search = SearchPrompt(forward, notebook)
+    return False
 
-    search_pat = ".*?" + input("")
-    search_pat = re.compile(search_pat)
+def search_input(char, notebook):
+    """
+    Handle a keypress while the search prompt is open.
+    """
+    prompt = notebook.search
+    if char in ("\n", "\r"):
+        # stop editing, but let the running search deliver its result
+        prompt.editing = False
+        if not prompt.query:
+            prompt.cancel()
+            notebook.set_search_pat(prompt.old_pat)
+    elif char == "\x1b" or (char in ("\x7f", "\x08") and not prompt.query):
+        prompt.cancel()
+        notebook.set_search_pat(prompt.old_pat)
+        notebook.row = prompt.start_row
+    elif char in ("\x7f", "\x08"):
+        prompt.query = prompt.query[:-1]
+        prompt.update(notebook)
+    elif char.isprintable():
+        prompt.query += char
+        prompt.update(notebook)
 
-    notebook.search_pat = search_pat
+def search_lines(cell):
+    """
+    Returns the lines of {cell} that are searched, or None if it has no
+    text. Line i of the result starts on row cell.line_row(i).
+    """
+    if isinstance(cell, TextCell):
+        return cell.text_lines
+    if isinstance(cell, ErrorOutputCell):
+        # search what is on screen, rather than the markup
+        return cell.display_lines()
+    return None
 
-    if forward == True:
-        return search_next(notebook)
-    else:
-        return search_prev(notebook)
+def find_next(pat, cells, row, cancel=None):
+    """
+    Returns the display row of the first line matching {pat} below {row}, or
+    None. {cells} is a list of (display row, cell) pairs.
+    """
+    for line, cell in cells:
+        if cancel is not None and cancel.is_set():
+            return None
 
-def search_next(notebook):
-    if notebook.search_pat is None:
-        return False
+        if line + cell.n_lines < row:
+            continue
 
-    for line, cell in notebook.cell_displays.items():
-        if line + cell.n_lines < notebook.row:
+        lines = search_lines(cell)
+        if lines is None:
             continue
 
-        if not isinstance(cell, TextCell):
+        for i, l in enumerate(lines):
+            if pat.search(l) and line + cell.line_row(i) + 2 > row:
+                return line + cell.line_row(i) + 2
+
+    return None
+
+def find_prev(pat, cells, row, cancel=None):
+    """
+    Returns the display row of the last line matching {pat} above {row}, or
+    None.
+    """
+    for line, cell in reversed(cells):
+        if cancel is not None and cancel.is_set():
+            return None
+
+        if line >= row:
             continue
 
-        try:
-            offset = next(i for i, l in enumerate(cell.text_lines) if
-                          (notebook.search_pat.match(l) and
-                              i + line > notebook.row))
-            goto(line + offset + 2, notebook)
-            return False
-        except StopIteration:
+        lines = search_lines(cell)
+        if lines is None:
             continue
 
+        for i in reversed(range(len(lines))):
+            if (pat.search(lines[i]) and
+                    line + cell.line_row(i) + 2 < row):
+                return line + cell.line_row(i) + 2
+
+    return None
+
+def search_next(notebook):
+    if notebook.search_pat is None:
+        return False
+
+    row = find_next(notebook.search_pat, list(notebook.cell_displays.items()),
+                    notebook.row)
+    if row is not None:
+        goto(row, notebook)
     return False
 
 def search_prev(notebook):
     if notebook.search_pat is None:
         return False
 
-    for line, cell in reversed(notebook.cell_displays.items()):
-        # Skip to the next if we are on the first line of a cell
-        if line > notebook.row - 3:
-            continue
-
-        if not isinstance(cell, TextCell):
-            continue
+    row = find_prev(notebook.search_pat, list(notebook.cell_displays.items()),
+                    notebook.row)
+    if row is not None:
+        goto(row, notebook)
+    return False
 
-        try:
-            offset = next(i for i, l in enumerate(reversed(cell.text_lines)) if
-                          (notebook.search_pat.match(l) and
-                              line + i < notebook.row))
-            goto(line + offset + 2, notebook)
-            return False
-        except StopIteration:
-            continue
+def zoom(step, notebook):
+    """
+    Make images bigger (negative {step}) or smaller (positive {step}).
+    """
+    level = min(max(zoom_level() + step, 0), ZOOM_LEVELS - 1)
+    set_zoom(level, notebook)
+    return False
 
+def toggle_overview(notebook):
+    """
+    Switch between the current zoom level and thumbnail sized images.
+    """
+    if zoom_level() == ZOOM_LEVELS - 1:
+        set_zoom(_METADATA.get("overview_zoom", 0), notebook)
+    else:
+        _METADATA["overview_zoom"] = zoom_level()
+        set_zoom(ZOOM_LEVELS - 1, notebook)
     return False
 
+def set_zoom(level, notebook):
+    if level == zoom_level():
+        return
+    # all zoom levels are decoded up front, so this only has to work out
+    # where cells sit again
+    _METADATA["zoom"] = level
+    notebook.relayout()
+
 def exit(_):
     return True
 
@@ -135,15 +287,41 @@ input_dict = {
             "?": partial(search, False),
             "n": search_next,
             "N": search_prev,
+            "+": partial(zoom, -1),
+            "-": partial(zoom, 1),
+            "o": toggle_overview,
             'q': exit,
         }
 
 def handle_input(char, notebook):
     if char == "":
         return False
+    if notebook.search is not None and notebook.search.editing:
+        search_input(char, notebook)
+        notebook.needs_redraw = True
+        return False
     try:
         stop = input_dict[char](notebook)
         notebook.needs_redraw = True
         return stop
     except KeyError:
         return False
+
+def handle_file_change(json_notebook, notebook, follow=False):
+    """
+    Update the notebook after the file has changed. In follow mode, the view
+    stays pinned to the bottom if it was there before.
+    """
+    old_notebook = notebook
+    if follow:
+        row = notebook.row
+        pinned = row >= notebook.size + 2 - _METADATA["term_height"]
+        notebook = follow_nb(json_notebook, notebook)
+        goto(-1 if pinned else row, notebook)
+    else:
+        notebook = reparse_nb(json_notebook, notebook)
+
+    notebook.search = old_notebook.search
+    notebook.set_search_pat(old_notebook.search_pat)
+    notebook.free_images()
+    return notebook
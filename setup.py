@@ -23,5 +23,9 @@ setuptools.setup(
                 ]
         },
     python_requires='>=3.6',
-    install_requires = requirements
+    install_requires = requirements,
+    extras_require={
+            # svg outputs are rendered with cairosvg, which needs cairo
+            "svg": ["cairosvg"]
+        }
 )